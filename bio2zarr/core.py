@@ -1,10 +1,13 @@
 import concurrent.futures as cf
 import contextlib
 import dataclasses
+import itertools
 import logging
+import math
 import multiprocessing
 import os
 import os.path
+import sys
 import threading
 import time
 
@@ -13,52 +16,98 @@ import numpy as np
 import tqdm
 import zarr
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 logger = logging.getLogger(__name__)
 
 numcodecs.blosc.use_threads = False
 
 
+# Bounds of the signed integer dtypes, so that dtype selection compares
+# plain Python ints rather than allocating np.iinfo objects per call.
+_int_dtype_ranges = [
+    ("i1", -(2**7), 2**7 - 1),
+    ("i2", -(2**15), 2**15 - 1),
+    ("i4", -(2**31), 2**31 - 1),
+    ("i8", -(2**63), 2**63 - 1),
+]
+
+
 def min_int_dtype(min_value, max_value):
     if min_value > max_value:
         raise ValueError("min_value must be <= max_value")
-    for a_dtype in ["i1", "i2", "i4", "i8"]:
-        info = np.iinfo(a_dtype)
-        if info.min <= min_value and max_value <= info.max:
+    for a_dtype, dtype_min, dtype_max in _int_dtype_ranges:
+        if dtype_min <= min_value and max_value <= dtype_max:
             return a_dtype
     raise OverflowError("Integer cannot be represented")
 
 
-def chunk_aligned_slices(z, n, max_chunks=None):
+def chunk_aligned_slices(z, n, max_chunks=None, weights=None):
     """
     Returns at n slices in the specified zarr array, aligned
-    with its chunks
+    with its chunks.
+
+    If weights is specified it must give a weight for each chunk
+    considered (e.g., approximate bytes or records per chunk), and the
+    slices are chosen to have roughly equal total weight instead of an
+    equal number of chunks. Fewer than n slices may be returned when
+    the weights are very skewed.
     """
     chunk_size = z.chunks[0]
-    num_chunks = int(np.ceil(z.shape[0] / chunk_size))
+    num_chunks = (z.shape[0] + chunk_size - 1) // chunk_size
     if max_chunks is not None:
         num_chunks = min(num_chunks, max_chunks)
-    slices = []
-    splits = np.array_split(np.arange(num_chunks), min(n, num_chunks))
-    for split in splits:
-        start = split[0] * chunk_size
-        stop = (split[-1] + 1) * chunk_size
-        stop = min(stop, z.shape[0])
-        slices.append((start, stop))
-    return slices
+    k = min(n, num_chunks)
+    if weights is None:
+        # Distribute the chunks over the slices as evenly as possible,
+        # with the first num_chunks % k slices getting one extra.
+        base, rem = divmod(num_chunks, k)
+        starts = [i * base + min(i, rem) for i in range(k)]
+    else:
+        weights = np.asarray(weights)
+        if len(weights) != num_chunks:
+            raise ValueError("There must be a weight for each chunk")
+        cumulative = np.cumsum(weights)
+        targets = np.linspace(0, cumulative[-1], k + 1)[1:-1]
+        bounds = np.searchsorted(cumulative, targets)
+        starts = [0]
+        for target, bound in zip(targets, bounds):
+            bound = int(min(bound, num_chunks - 1))
+            # Include the chunk straddling the target if that leaves the
+            # neighbouring slices more balanced.
+            before = cumulative[bound - 1] if bound > 0 else 0
+            if abs(cumulative[bound] - target) <= abs(target - before):
+                bound += 1
+            if starts[-1] < bound < num_chunks:
+                starts.append(bound)
+    stops = starts[1:] + [num_chunks]
+    return [
+        (start * chunk_size, min(stop * chunk_size, z.shape[0]))
+        for start, stop in zip(starts, stops)
+    ]
+
+
+def _du_entry_sizes(path):
+    with os.scandir(path) as entries:
+        for entry in entries:
+            yield entry.stat(follow_symlinks=False).st_size
+            if entry.is_dir(follow_symlinks=False):
+                yield from _du_entry_sizes(entry.path)
 
 
 def du(path):
     """
     Return the total bytes stored at this path.
     """
+    # os.scandir reuses the stat information gathered while listing each
+    # directory, where os.walk + getsize stats every entry again. This
+    # roughly halves the syscalls on stores with many chunk files.
     total = os.path.getsize(path)
-    # pathlib walk method doesn't exist until 3.12 :(
-    for root, dirs, files in os.walk(path):
-        for lst in [dirs, files]:
-            for name in lst:
-                fullname = os.path.join(root, name)
-                size = os.path.getsize(fullname)
-                total += size
+    if os.path.isdir(path):
+        total += sum(_du_entry_sizes(path))
     logger.debug(f"du({path}) = {total}")
     return total
 
@@ -71,7 +120,11 @@ class SynchronousExecutor(cf.Executor):
 
 
 def wait_on_futures(futures):
-    for future in cf.as_completed(futures):
+    # as_completed registers a callback per future, which has measurable
+    # overhead for many small tasks; a single wait for everything is all
+    # we need in the common all-succeed case.
+    done, _ = cf.wait(futures, return_when=cf.ALL_COMPLETED)
+    for future in done:
         exception = future.exception()
         if exception is not None:
             cancel_futures(futures)
@@ -88,6 +141,24 @@ def cancel_futures(futures):
         future.cancel()
 
 
+def aligned_empty(shape, dtype, align=64):
+    """
+    Return an uninitialised array whose data buffer is aligned to the
+    specified byte boundary. np.empty guarantees nothing beyond the
+    allocator's alignment, and blosc's shuffle pass benefits from
+    cache-line aligned input.
+    """
+    dtype = np.dtype(dtype)
+    nbytes = math.prod(shape) * dtype.itemsize
+    raw = np.empty(nbytes + align, dtype=np.uint8)
+    offset = (-raw.ctypes.data) % align
+    return raw[offset : offset + nbytes].view(dtype).reshape(shape)
+
+
+# NOTE: instances are created inside the worker process that fills them
+# and the buffer is flushed to zarr in-process; it never crosses the
+# executor boundary, so it does not need to be picklable (and there is
+# no serialisation copy to be saved by e.g. shared memory backing).
 @dataclasses.dataclass
 class BufferedArray:
     array: zarr.Array
@@ -99,28 +170,48 @@ class BufferedArray:
         self.array = array
         self.array_offset = offset
         assert offset % array.chunks[0] == 0
+        # Cache the array metadata; these go through zarr's property
+        # wrappers and get read on every flush.
+        self._chunks = tuple(array.chunks)
+        self._shape = tuple(array.shape)
+        self._name = array.name
         dims = list(array.shape)
         dims[0] = min(array.chunks[0], array.shape[0])
-        self.buff = np.empty(dims, dtype=array.dtype)
-        # Explicitly Fill with zeros here to make any out-of-memory errors happen
-        # quickly.
-        self.buff[:] = 0
+        if array.dtype == object:
+            # Object (string) buffers hold references, so alignment is
+            # meaningless and view() is not permitted on them.
+            self.buff = np.empty(dims, dtype=array.dtype)
+        else:
+            self.buff = aligned_empty(dims, array.dtype)
+        # We used to explicitly fill the buffer with zeros here to make any
+        # out-of-memory errors happen quickly, but a full memset is a
+        # significant startup tax on multi-GB genotype buffers. Set
+        # BIO2ZARR_EAGER_ALLOC to touch one byte per page instead, which
+        # forces allocation without writing every byte.
+        if os.environ.get("BIO2ZARR_EAGER_ALLOC") and self.buff.dtype != object:
+            self.buff.ravel().view(np.uint8)[::4096] = 0
         self.buffer_row = 0
-
-    @property
-    def variants_chunk_size(self):
-        return self.buff.shape[0]
+        self.variants_chunk_size = self.buff.shape[0]
 
     def next_buffer_row(self):
-        if self.buffer_row == self.variants_chunk_size:
+        self.next_buffer_rows(1)
+        return self.buffer_row - 1
+
+    def next_buffer_rows(self, n):
+        """
+        Return a writable view of the next n unused buffer rows, flushing
+        the buffer first if there is not enough space left in it.
+        """
+        assert 0 < n <= self.variants_chunk_size
+        if self.buffer_row + n > self.variants_chunk_size:
             self.flush()
-        row = self.buffer_row
-        self.buffer_row += 1
-        return row
+        rows = self.buff[self.buffer_row : self.buffer_row + n]
+        self.buffer_row += n
+        return rows
 
     def flush(self):
         if self.buffer_row != 0:
-            if len(self.array.chunks) <= 1:
+            if len(self._chunks) <= 1:
                 sync_flush_1d_array(
                     self.buff[: self.buffer_row], self.array, self.array_offset
                 )
@@ -128,19 +219,86 @@ class BufferedArray:
                 sync_flush_2d_array(
                     self.buff[: self.buffer_row], self.array, self.array_offset
                 )
-            # FIXME the array.name doesn't seem to be working here for some reason
-            logger.debug(
-                f"Flushed <{self.array.name} {self.array.shape} "
-                f"{self.array.dtype}> "
-                f"{self.array_offset}:{self.array_offset + self.buffer_row}"
-                f"{self.buff.nbytes / 2**20: .2f}Mb"
-            )
-            self.array_offset += self.variants_chunk_size
+            # Guard so we don't pay for string formatting on every flush
+            # when debug logging is off.
+            if logger.isEnabledFor(logging.DEBUG):
+                # FIXME the array.name doesn't seem to be working here
+                # for some reason
+                logger.debug(
+                    "Flushed <%s %s %s> %d:%d %.2fMb",
+                    self._name,
+                    self._shape,
+                    self.buff.dtype,
+                    self.array_offset,
+                    self.array_offset + self.buffer_row,
+                    self.buff.nbytes / 2**20,
+                )
+            self.array_offset += self.buffer_row
             self.buffer_row = 0
 
 
+def _drop_flushed_chunks_page_cache(zarr_array, offset, num_rows):
+    """
+    Advise the kernel that the chunk files covering the flushed rows
+    won't be read back, so that long encode runs don't crowd the input
+    data out of the page cache. Pages still dirty are left alone until
+    writeback, so this is best-effort.
+    """
+    if sys.platform != "linux":  # pragma: no cover
+        return
+    dir_path = getattr(zarr_array.store, "dir_path", None)
+    if dir_path is None:
+        # Not a DirectoryStore, so there are no files to advise on.
+        return
+    chunk_length = zarr_array.chunks[0]
+    row_blocks = range(
+        offset // chunk_length, (offset + num_rows - 1) // chunk_length + 1
+    )
+    other_blocks = [range(g) for g in zarr_array.cdata_shape[1:]]
+    for coords in itertools.product(row_blocks, *other_blocks):
+        # NOTE: _chunk_key is private zarr API, but it's the only way to
+        # get at the chunk file names and has been stable across v2.
+        path = os.path.join(dir_path(), zarr_array._chunk_key(coords))
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            # Chunk not written (e.g. all fill value); nothing to drop.
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+if numba is not None:
+
+    @numba.njit(cache=True)
+    def _all_fill_kernel(np_buffer, fill_value):
+        for value in np_buffer:
+            if value != fill_value:
+                return False
+        return True
+
+
+def _buffer_is_fill(np_buffer, fill_value):
+    # np.array_equiv always scans (and broadcasts) the whole buffer; the
+    # numba kernel, specialised per dtype at runtime, bails out at the
+    # first non-fill element, which is typically the very first one.
+    if numba is not None and np_buffer.dtype != object:
+        return bool(_all_fill_kernel(np_buffer, fill_value))
+    return bool(np.array_equiv(np_buffer, fill_value))
+
+
 def sync_flush_1d_array(np_buffer, zarr_array, offset):
-    zarr_array[offset : offset + np_buffer.shape[0]] = np_buffer
+    # If the buffer is entirely fill value we can skip the write: zarr
+    # leaves the chunks uninitialised, which reads back as fill and saves
+    # a file per chunk on a DirectoryStore. This is common for sparse
+    # fields where most rows are missing. Progress is still reported so
+    # the bar reaches its total.
+    fill_value = zarr_array.fill_value
+    if fill_value is None or not _buffer_is_fill(np_buffer, fill_value):
+        zarr_array[offset : offset + np_buffer.shape[0]] = np_buffer
+        _drop_flushed_chunks_page_cache(zarr_array, offset, np_buffer.shape[0])
     update_progress(np_buffer.nbytes)
 
 
@@ -148,17 +306,34 @@ def sync_flush_2d_array(np_buffer, zarr_array, offset):
     # Write chunks in the second dimension 1-by-1 to make progress more
     # incremental, and to avoid large memcopies in the underlying
     # encoder implementations.
-    s = slice(offset, offset + np_buffer.shape[0])
+    chunk_length = zarr_array.chunks[0]
     samples_chunk_size = zarr_array.chunks[1]
-    # TODO use zarr chunks here for simplicity
     zarr_array_width = zarr_array.shape[1]
-    start = 0
-    while start < zarr_array_width:
-        stop = min(start + samples_chunk_size, zarr_array_width)
-        chunk_buffer = np_buffer[:, start:stop]
-        zarr_array[s, start:stop] = chunk_buffer
-        update_progress(chunk_buffer.nbytes)
-        start = stop
+    if offset % chunk_length == 0 and (
+        np_buffer.shape[0] == chunk_length
+        or offset + np_buffer.shape[0] == zarr_array.shape[0]
+    ):
+        # The buffer lines up with a row of chunks (either a full row, or
+        # the final short flush at the end of the array, where the block
+        # indexer clips to the array bounds), so we can write the chunks
+        # directly and skip the more general (and more expensive)
+        # read-modify-write machinery in __setitem__.
+        row_block = offset // chunk_length
+        num_sample_blocks = int(np.ceil(zarr_array_width / samples_chunk_size))
+        for j in range(num_sample_blocks):
+            start = j * samples_chunk_size
+            chunk_buffer = np_buffer[:, start : start + samples_chunk_size]
+            zarr_array.blocks[row_block, j] = chunk_buffer
+            update_progress(chunk_buffer.nbytes)
+    else:
+        # Unaligned writes go through __setitem__'s read-modify-write
+        # machinery for every chunk they touch regardless of how we slice
+        # them, so there's nothing to be gained from writing sample-chunk
+        # by sample-chunk here. Issue one bulk write and a single progress
+        # update rather than re-entering the codec pipeline per slice.
+        zarr_array[offset : offset + np_buffer.shape[0]] = np_buffer
+        update_progress(np_buffer.nbytes)
+    _drop_flushed_chunks_page_cache(zarr_array, offset, np_buffer.shape[0])
 
 
 @dataclasses.dataclass
@@ -170,37 +345,102 @@ class ProgressConfig:
     poll_interval: float = 0.01
 
 
+class _ProgressCounter:
+    """
+    Cross-process counter that notifies a condition variable on update,
+    so that the display side can sleep until there is something to report
+    rather than polling on a timer.
+    """
+
+    def __init__(self):
+        # lock=False gives us the raw shared value; writes are serialised
+        # through the condition's lock, and the display side tolerates
+        # unlocked reads of a 64-bit value.
+        self.value = multiprocessing.Value("Q", 0, lock=False)
+        self.condition = multiprocessing.Condition()
+
+
 # NOTE: this approach means that we cannot have more than one
 # progressable thing happening per source process. This is
 # probably fine in practise, but there could be corner cases
 # where it's not. Something to watch out for.
-_progress_counter = multiprocessing.Value("Q", 0)
+_progress_counter = _ProgressCounter()
+
+# Thresholds for batching updates to the shared counter; the lock behind
+# it is a cross-process semaphore, so taking it once per chunk write from
+# the flush loops is a syscall per chunk.
+_progress_batch_size = 4 * 2**20
+_progress_batch_interval = 0.1
+
+
+class _BatchedProgress(threading.local):
+    def __init__(self):
+        self.pending = 0
+        self.last_flush = 0
+
+
+_batched_progress = _BatchedProgress()
 
 
 def update_progress(inc):
-    with _progress_counter.get_lock():
-        _progress_counter.value += inc
+    # Accumulate increments locally and push them to the shared counter
+    # in batches. ParallelWorkManager flushes the residual when each
+    # task completes, so the counter is exact at future resolution.
+    state = _batched_progress
+    state.pending += inc
+    if (
+        state.pending >= _progress_batch_size
+        or time.monotonic() - state.last_flush >= _progress_batch_interval
+    ):
+        flush_progress()
+
+
+def flush_progress():
+    state = _batched_progress
+    if state.pending > 0:
+        with _progress_counter.condition:
+            _progress_counter.value.value += state.pending
+            _progress_counter.condition.notify()
+        state.pending = 0
+    state.last_flush = time.monotonic()
 
 
 def get_progress():
-    with _progress_counter.get_lock():
-        val = _progress_counter.value
-    return val
+    return _progress_counter.value.value
 
 
 def set_progress(value):
-    with _progress_counter.get_lock():
-        _progress_counter.value = value
+    _batched_progress.pending = 0
+    with _progress_counter.condition:
+        _progress_counter.value.value = value
+
+
+def _run_task(fn, *args, **kwargs):
+    # Flush any batched progress before the future resolves, so that the
+    # shared counter is exact once all tasks have completed.
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        flush_progress()
 
 
 class ParallelWorkManager(contextlib.AbstractContextManager):
-    def __init__(self, worker_processes=1, progress_config=None):
+    def __init__(
+        self, worker_processes=1, progress_config=None, initializer=None, initargs=()
+    ):
         if worker_processes <= 0:
             # NOTE: this is only for testing, not for production use!
             self.executor = SynchronousExecutor()
+            if initializer is not None:
+                initializer(*initargs)
         else:
+            # The initializer lets callers set up per-worker state (e.g. open
+            # stores and load metadata) once per process, so that submitted
+            # tasks only need to carry cheap arguments like integer indexes.
             self.executor = cf.ProcessPoolExecutor(
                 max_workers=worker_processes,
+                initializer=initializer,
+                initargs=initargs,
             )
         self.futures = set()
 
@@ -218,12 +458,17 @@ class ParallelWorkManager(contextlib.AbstractContextManager):
         )
         self.completed = False
         self.completed_lock = threading.Lock()
-        self.progress_thread = threading.Thread(
-            target=self._update_progress_worker,
-            name="progress-update",
-            daemon=True,  # Avoids deadlock on exit in awkward error conditions
-        )
-        self.progress_thread.start()
+        # The poller thread only exists to refresh the display; when the
+        # bar is disabled the inline updates on the future-management
+        # paths are all we need, and we don't pay for a thread at all.
+        self.progress_thread = None
+        if progress_config.show:
+            self.progress_thread = threading.Thread(
+                target=self._update_progress_worker,
+                name="progress-update",
+                daemon=True,  # Avoids deadlock on exit in awkward error conditions
+            )
+            self.progress_thread.start()
 
     def _update_progress(self):
         current = get_progress()
@@ -235,13 +480,16 @@ class ParallelWorkManager(contextlib.AbstractContextManager):
         completed = False
         while not completed:
             self._update_progress()
-            time.sleep(self.progress_config.poll_interval)
+            # Sleep until a worker notifies us of new progress, with the
+            # poll interval as a backstop.
+            with _progress_counter.condition:
+                _progress_counter.condition.wait(self.progress_config.poll_interval)
             with self.completed_lock:
                 completed = self.completed
         logger.debug("Exit progress thread")
 
     def submit(self, *args, **kwargs):
-        future = self.executor.submit(*args, **kwargs)
+        future = self.executor.submit(_run_task, *args, **kwargs)
         self.futures.add(future)
         return future
 
@@ -253,10 +501,12 @@ class ParallelWorkManager(contextlib.AbstractContextManager):
             if exception is not None:
                 raise exception
         self.futures = not_done
+        self._update_progress()
         return done
 
     def results_as_completed(self):
         for future in cf.as_completed(self.futures):
+            self._update_progress()
             yield future.result()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -264,17 +514,17 @@ class ParallelWorkManager(contextlib.AbstractContextManager):
             wait_on_futures(self.futures)
         else:
             cancel_futures(self.futures)
-        # There's probably a much cleaner way of doing this with a Condition
-        # or something, but this seems to work OK for now. This setup might
-        # make small conversions a bit laggy as we wait on the sleep interval
-        # though.
         with self.completed_lock:
             self.completed = True
+        # Wake the progress thread so it notices completion immediately.
+        with _progress_counter.condition:
+            _progress_counter.condition.notify_all()
         self.executor.shutdown(wait=False)
         # FIXME there's currently some thing weird happening at the end of
         # Encode 1D for 1kg-p3. The progress bar disappears, like we're
         # setting a total of zero or something.
-        self.progress_thread.join()
+        if self.progress_thread is not None:
+            self.progress_thread.join()
         self._update_progress()
         self.progress_bar.close()
         return False
@@ -32,20 +32,16 @@ def encode_genotypes_slice(bed_path, zarr_path, start, stop):
         logger.debug(f"Reading bed slice {chunk_start}:{chunk_stop}")
         bed_chunk = bed.read(slice(chunk_start, chunk_stop), dtype=np.int8).T
         logger.debug(f"Got bed slice {humanfriendly.format_size(bed_chunk.nbytes)}")
-        # Probably should do this without iterating over rows, but it's a bit
-        # simpler and lines up better with the array buffering API. The bottleneck
-        # is in the encoding anyway.
-        for values in bed_chunk:
-            j = gt.next_buffer_row()
-            g = np.zeros_like(gt.buff[j])
-            g[values == -127] = -1
-            g[values == 2] = 1
-            g[values == 1, 0] = 1
-            gt.buff[j] = g
-            j = gt_phased.next_buffer_row()
-            gt_phased.buff[j] = False
-            j = gt_mask.next_buffer_row()
-            gt_mask.buff[j] = gt.buff[j] == -1
+        # Fill whole buffer chunks at a time with vectorised assignments;
+        # bed slices are chunk aligned so each one maps to a single block.
+        n = chunk_stop - chunk_start
+        g = gt.next_buffer_rows(n)
+        g[:] = 0
+        g[bed_chunk == -127] = -1
+        g[bed_chunk == 2] = 1
+        g[bed_chunk == 1, 0] = 1
+        gt_phased.next_buffer_rows(n)[:] = False
+        gt_mask.next_buffer_rows(n)[:] = g == -1
         chunk_start = chunk_stop
     gt.flush()
     gt_phased.flush()
@@ -2058,9 +2058,31 @@ class VcfZarrWriter:
             units="B",
             show=show_progress,
         )
-        with core.ParallelWorkManager(num_workers, progress_config) as pwm:
+        with core.ParallelWorkManager(
+            num_workers,
+            progress_config,
+            initializer=_init_encode_partition_worker,
+            initargs=(self.path,),
+        ) as pwm:
             for partition_index in range(num_partitions):
-                pwm.submit(self.encode_partition, partition_index)
+                pwm.submit(_encode_partition_worker, partition_index)
+
+
+# Per-worker writer used when encoding partitions in parallel. Loading the
+# metadata and opening the ICF store are done once per worker process by the
+# initializer, so that submitting a partition only sends its index instead of
+# pickling the writer (schema, partition list, etc) for every task.
+_encode_partition_writer = None
+
+
+def _init_encode_partition_worker(zarr_path):
+    global _encode_partition_writer
+    _encode_partition_writer = VcfZarrWriter(zarr_path)
+    _encode_partition_writer.load_metadata()
+
+
+def _encode_partition_worker(partition_index):
+    _encode_partition_writer.encode_partition(partition_index)
 
 
 def mkschema(if_path, out):
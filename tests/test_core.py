@@ -103,6 +103,70 @@ class TestParallelWorkManager:
                 pwm.submit(frozenset, j)
 
 
+class TestAlignedEmpty:
+    @pytest.mark.parametrize("dtype", ["i1", "i4", "f8", "bool"])
+    @pytest.mark.parametrize("shape", [(1,), (100,), (10, 3, 2)])
+    def test_alignment(self, dtype, shape):
+        a = core.aligned_empty(shape, dtype)
+        assert a.shape == shape
+        assert a.dtype == np.dtype(dtype)
+        assert a.ctypes.data % 64 == 0
+
+    @pytest.mark.parametrize("align", [8, 32, 4096])
+    def test_align_values(self, align):
+        a = core.aligned_empty((10,), "i4", align=align)
+        assert a.ctypes.data % align == 0
+
+
+class TestBufferedArray:
+    def test_next_buffer_rows_is_view(self):
+        z = zarr.zeros(20, chunks=5, dtype=int)
+        ba = core.BufferedArray(z, 0)
+        rows = ba.next_buffer_rows(3)
+        rows[:] = 1
+        assert np.all(ba.buff[:3] == 1)
+        assert ba.buffer_row == 3
+
+    def test_next_buffer_rows_flushes_when_full(self):
+        z = zarr.zeros(20, chunks=5, dtype=int)
+        ba = core.BufferedArray(z, 0)
+        ba.next_buffer_rows(4)[:] = 1
+        ba.next_buffer_rows(2)[:] = 2
+        assert ba.buffer_row == 2
+        assert np.array_equal(z[:4], np.ones(4, dtype=int))
+
+    @pytest.mark.parametrize("size", [20, 22])
+    @pytest.mark.parametrize("block_size", [1, 2, 4, 5])
+    def test_block_round_trip(self, size, block_size):
+        z = zarr.zeros(size, chunks=5, dtype=int)
+        ba = core.BufferedArray(z, 0)
+        for start in range(0, size, block_size):
+            stop = min(start + block_size, size)
+            ba.next_buffer_rows(stop - start)[:] = np.arange(start, stop)
+        ba.flush()
+        assert np.array_equal(z[:], np.arange(size))
+
+    def test_all_fill_flush_not_written(self):
+        z = zarr.full(20, -1, chunks=5, dtype=int)
+        ba = core.BufferedArray(z, 0)
+        for _ in range(20):
+            j = ba.next_buffer_row()
+            ba.buff[j] = -1
+        ba.flush()
+        assert z.nchunks_initialized == 0
+        assert np.all(z[:] == -1)
+
+    @pytest.mark.parametrize("size", [20, 23])
+    def test_row_round_trip(self, size):
+        z = zarr.zeros(size, chunks=5, dtype=int)
+        ba = core.BufferedArray(z, 0)
+        for value in range(size):
+            j = ba.next_buffer_row()
+            ba.buff[j] = value
+        ba.flush()
+        assert np.array_equal(z[:], np.arange(size))
+
+
 class TestChunkAlignedSlices:
     @pytest.mark.parametrize(
         ("n", "expected"),
@@ -136,6 +200,28 @@ class TestChunkAlignedSlices:
         result = core.chunk_aligned_slices(z, n, max_chunks=max_chunks)
         assert result == expected
 
+    @pytest.mark.parametrize(
+        ("n", "weights", "expected"),
+        [
+            (1, [1, 2, 3, 4], [(0, 20)]),
+            (2, [1, 1, 1, 1], [(0, 10), (10, 20)]),
+            (2, [10, 1, 1, 1], [(0, 5), (5, 20)]),
+            (2, [1, 1, 1, 10], [(0, 15), (15, 20)]),
+            (2, [0, 0, 1, 1], [(0, 15), (15, 20)]),
+            # Heavily skewed weights can return fewer than n slices
+            (4, [1, 1, 1, 10], [(0, 15), (15, 20)]),
+        ],
+    )
+    def test_20_chunk_5_weights(self, n, weights, expected):
+        z = zarr.array(np.arange(20), chunks=5, dtype=int)
+        result = core.chunk_aligned_slices(z, n, weights=weights)
+        assert result == expected
+
+    def test_bad_weights(self):
+        z = zarr.array(np.arange(20), chunks=5, dtype=int)
+        with pytest.raises(ValueError, match="weight for each chunk"):
+            core.chunk_aligned_slices(z, 2, weights=[1, 1])
+
     @pytest.mark.parametrize(
         ("n", "expected"),
         [